@@ -13,15 +13,24 @@
     :licence: GPL v3, see LICENCE for details.
 """
 
+import codecs
+import copy
 import csv
+import functools
+import hashlib
 import importlib
 import json
 import os
+import re
+import tempfile
+import threading
+import time
 import yaml
 
 from jsonpointer import resolve_pointer
 from traceback import format_exception, format_exception_only
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from docutils import nodes, utils
 from docutils.parsers.rst import Directive, DirectiveError
@@ -30,10 +39,24 @@ from docutils.utils import SystemMessagePropagation
 from docutils.utils.error_reporting import SafeString
 from .wide_format import WideFormat, NOESC
 
+try:
+    # use the libyaml based loader when PyYAML was built with it
+    from yaml import CSafeLoader as _BaseLoader
+except ImportError:
+    _BaseLoader = yaml.SafeLoader
 
-def pairwise(seq):
-    """ Iterate over pairs in a sequence """
-    return zip(seq, seq[1:])
+_WILDCARDS = frozenset(('*', '**'))
+
+_MISSING = object()
+
+# double the backslashes in front of \\( and \\) in one pass
+_ESCAPED_PAREN = re.compile(r'\\\\([()])')
+
+# json numbers that YAML 1.1 reads as a float
+_YAML_FLOAT = re.compile(r'-?[0-9]+\.[0-9]+(?:[eE][-+][0-9]+)?$')
+
+# wildcard opcodes of compiled json paths
+OP_WILD, OP_DEEP_WILD = range(2)
 
 
 def maybe_int(val):
@@ -45,98 +68,377 @@ def maybe_int(val):
 
 
 def json_path_validate(path):
-    """ Check that json path doesn't contain consecutive or trailing wildcards """
-    forbidden = {
-        ('**', '**'),
-        ('**', '*'),
-        ('*', '**'),
-        ('*', '*')
-    }
+    """ Check that json path isn't empty and doesn't contain consecutive wildcards """
+    if not path:
+        return False
+
+    prev = False
+    for p in path:
+        cur = p in _WILDCARDS
+        if cur and prev:
+            return False
+        prev = cur
+    return True
+
 
-    return set(pairwise(path)) & forbidden == set()
+def _get_item(obj, key):
+    """ Return `obj[key]` or _MISSING when `obj` has no such key or index """
+    if isinstance(obj, dict):
+        return obj.get(key, _MISSING)
+    if isinstance(obj, list) and isinstance(key, int) and -len(obj) <= key < len(obj):
+        return obj[key]
+    return _MISSING
 
 
-def _json_fan_out(doc, path, transform, deep=False):
+def _json_fan_out(doc, wildcards, transform):
     """ Process */** wildcards in the path by fanning out the processing to multiple keys """
-    if not path:
-        if isinstance(doc, list):
-            for r in range(len(doc)):
+    steps = []
+    for op in wildcards:
+        if op[1] is not None:
+            steps.append(op)
+        elif isinstance(doc, list):
+            # backwards so removing items doesn't shift the ones still to come
+            for r in reversed(range(len(doc))):
                 transform(doc, r)
+    if not steps:
         return
 
-    targets = []
+    stack = [(doc, steps)]
+
+    # Walk the (sub)document with an explicit stack rather than recursing
+    # into every nested level for deep wildcards, all wildcards at the same
+    # location in the document share a single walk
+    while stack:
+        obj, steps = stack.pop()
+        if isinstance(obj, dict):
+            items = obj.items()
+        elif isinstance(obj, list):
+            items = enumerate(obj)
+        else:
+            continue
+
+        deep = [op for op in steps if op[0] == OP_DEEP_WILD]
+        targets = []
+        for k, v in items:
+            descend = deep
+            for op in steps:
+                tag, rest, tail = op
+                if k == rest[0][0]:
+                    targets.append(rest)
+                    if tag == OP_DEEP_WILD:
+                        descend = [d for d in descend if d is not op]
+                elif tag == OP_WILD and tail:
+                    _json_bind(v, tail, transform)
+            if descend:
+                stack.append((v, descend))
+
+        # Since transformers can mutate the original document
+        # we need to process them once we're done iterating
+        for rest in targets:
+            _json_bind(obj, rest, transform)
+
+
+def _json_bind(doc, program, transform):
+    """ Bind (sub)document to a particular compiled path """
+    keys, wildcard = program
+    obj = doc
+    last = obj
+
+    for key in keys:
+        last = obj
+        obj = _get_item(obj, key)
+        if obj is _MISSING:
+            return
 
-    def deeper(v):
-        if deep:
-            _json_fan_out(v, path, transform, deep)
+    if wildcard:
+        _json_fan_out(obj, (wildcard,), transform)
+    elif keys:
+        transform(last, keys[-1])
+
+
+def _path_trie(programs):
+    """
+    Merge compiled paths into a trie on their leading keys.
+
+    Every node holds the keys transformed at that location, the wildcards
+    starting there and the child nodes by key.
+    """
+    root = {'leaves': [], 'wildcards': [], 'children': {}}
+    for keys, wildcard in programs:
+        if wildcard is None:
+            keys, leaf = keys[:-1], keys[-1]
+        node = root
+        for key in keys:
+            node = node['children'].setdefault(
+                key, {'leaves': [], 'wildcards': [], 'children': {}})
+        if wildcard is None:
+            node['leaves'].append(leaf)
         else:
-            if len(path) > 1 :
-                _json_bind(v, path[1:], transform)
+            node['wildcards'].append(wildcard)
+    return root
+
+
+def _json_bind_trie(doc, node, transform):
+    """ Bind (sub)document to all paths in a trie during a single walk """
+    for key in node['leaves']:
+        if _get_item(doc, key) is not _MISSING:
+            transform(doc, key)
+    if node['wildcards']:
+        _json_fan_out(doc, node['wildcards'], transform)
+    for key, child in node['children'].items():
+        obj = _get_item(doc, key)
+        if obj is not _MISSING:
+            _json_bind_trie(obj, child, transform)
+
+
+def _has_index(program):
+    """ Check whether a compiled path addresses list items by index """
+    if program is None:
+        return False
+    keys, wildcard = program
+    if any(isinstance(key, int) for key in keys):
+        return True
+    return wildcard is not None and (_has_index(wildcard[1]) or _has_index(wildcard[2]))
+
+
+def _json_bind_paths(doc, programs, transform):
+    """
+    Bind (sub)document to compiled paths in the order given.
+
+    Consecutive paths are merged into a trie and applied in a single walk.
+    Paths with list indexes are bound one at a time in their place, removing
+    a list item shifts the items after it so their order matters.
+    """
+    batch = []
+    for program in programs:
+        if not _has_index(program):
+            batch.append(program)
+            continue
+        if batch:
+            _json_bind_trie(doc, _path_trie(batch), transform)
+            batch = []
+        _json_bind(doc, program, transform)
+    if batch:
+        _json_bind_trie(doc, _path_trie(batch), transform)
+
+
+def _compile_program(parts):
+    """
+    Compile path parts into a program for `_json_bind`.
+
+    The program is a ``(keys, wildcard)`` pair: the keys leading up to the
+    first wildcard and either None or the wildcard as ``(OP_WILD, rest, tail)``
+    or ``(OP_DEEP_WILD, rest, None)``. `rest` and `tail` are the compiled
+    programs for the parts after the wildcard and after the key following it,
+    or None when there are no such parts.
+    """
+    if not parts:
+        return None
+
+    for idx, p in enumerate(parts):
+        if p == '**':
+            return parts[:idx], (OP_DEEP_WILD, _compile_program(parts[idx+1:]), None)
+        if p == '*':
+            return parts[:idx], (OP_WILD,
+                                 _compile_program(parts[idx+1:]),
+                                 _compile_program(parts[idx+2:]))
+    return parts, None
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_path(path):
+    """ Split `path` into its parts, validate and compile them """
 
-    def iterate(iterator):
-        for k, v in iterator:
-            if k == path[0]:
-                targets.append(path)
-            else:
-                deeper(v)
+    # Try to cast parts of the path as int if possible so that we can support
+    # paths like `/some/array/0/something` and we don't end up with TypeError
+    # trying to index into a list with a string '0'
+    parts = tuple(maybe_int(p) for p in path.split('/')[1:])
 
-    if isinstance(doc, dict):
-        iterate(doc.items())
-    if isinstance(doc, list):
-        iterate(enumerate(doc))
+    if not json_path_validate(parts):
+        raise ValueError('Supplied JSON path is invalid')
 
-    # Since transformers can mutate the original document
-    # we need to process them once we're done iterating
-    for r in targets:
-        _json_bind(doc, r, transform)
+    return _compile_program(parts)
 
 
-def _json_bind(doc, path, transform):
-    """ Bind (sub)document to a particular path """
-    obj = doc
-    last = obj
+def json_path_transform(document, path, transformer):
+    """ Transform items in `document` conforming to `path` with a `transformer` in-place """
+    _json_bind(document, _compile_path(path), transformer)
 
-    for idx, p in enumerate(path):
-        if p in ('**', '*'):
-            return _json_fan_out(
-                obj,
-                path[idx+1:],
-                transform,
-                deep=(p == '**')
-            )
 
-        last = obj
-        try:
-            obj = obj[p]
-        except (KeyError, IndexError):
-            return
+class OrderedLoader(_BaseLoader):
+    """Allows you to use `pyyaml` to load as OrderedDict.
 
-    if path:
-        transform(last, path[-1])
+    Taken from https://stackoverflow.com/a/21912744/1927102
+    """
 
 
-def json_path_transform(document, path, transformer):
-    """ Transform items in `document` conforming to `path` with a `transformer` in-place """
+def _construct_mapping(loader, node):
+    loader.flatten_mapping(node)
+    return OrderedDict(loader.construct_pairs(node))
 
-    # Try to cast parts of the path as int if possible so that we can support
-    # paths like `/some/array/0/something` and we don't end up with TypeError
-    # trying to index into a list with a string '0'
-    parts = [maybe_int(p) for p in path.split('/')[1:]]
 
-    if not parts or not json_path_validate(parts):
-        raise ValueError('Supplied JSON path is invalid')
+OrderedLoader.add_constructor(
+    yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
+    _construct_mapping)
+
+
+def _parse_float(text):
+    """ Read json numbers the way the YAML loader does """
+    # YAML 1.1 needs a dot and a signed exponent, anything else (1e5, 1.5e3)
+    # is a string there
+    if _YAML_FLOAT.match(text):
+        return float(text)
+    return text
+
+
+@functools.lru_cache(maxsize=128)
+def _ordered_load(text):
+    """ Parse schema text, identical texts are only parsed once """
+    text = _ESCAPED_PAREN.sub(r'\\\\\\\\\1', text)
+    try:
+        # most schemas are plain json which is a lot cheaper to parse
+        result = json.loads(text, object_pairs_hook=OrderedDict,
+                            parse_float=_parse_float, parse_constant=str)
+    except ValueError:
+        result = yaml.load(text, OrderedLoader)
+    return result
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _get_session():
+    """ Return the requests session shared by all schema downloads """
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
 
-    _json_bind(document, parts, transformer)
+            session = requests.Session()
+            session.headers['User-Agent'] = 'sphinx-jsonschema'
+            # parallel readers share the connections
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+
+def _reset_session():
+    # forked parallel readers must not share the parent's pooled connections
+    global _session, _session_lock
+    _session = None
+    _session_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_session)
+
+
+def _url_cache_file(cache_dir, url):
+    return os.path.join(cache_dir, hashlib.sha1(url.encode()).hexdigest() + '.json')
+
+
+def _read_url_cache(cache_file):
+    try:
+        with open(cache_file, encoding='utf-8') as file:
+            entry = json.load(file)
+    except (IOError, ValueError):
+        return None
+
+    # anything that isn't an entry written by _write_url_cache is a cache miss
+    try:
+        valid = (isinstance(entry['body'], str)
+                 and isinstance(entry['fetched_at'], (int, float))
+                 and isinstance(entry['etag'], (str, type(None)))
+                 and isinstance(entry['last_modified'], (str, type(None))))
+    except (KeyError, TypeError):
+        valid = False
+    return entry if valid else None
+
+
+def _write_url_cache(cache_file, entry):
+    # write to a private file first so parallel readers never see a partial entry
+    cache_dir = os.path.dirname(cache_file)
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with open(fd, 'w', encoding='utf-8') as file:
+            json.dump(entry, file)
+        os.replace(tmp_file, cache_file)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+
+
+def _read_body(response):
+    """ Decode a streamed response without holding the complete body as bytes """
+    # only trust a charset the server declared, default to utf-8 otherwise
+    encoding = 'utf-8'
+    if 'charset' in response.headers.get('Content-Type', ''):
+        try:
+            encoding = codecs.lookup(response.encoding).name
+        except (LookupError, TypeError):
+            pass
+    decoder = codecs.getincrementaldecoder(encoding)()
+    chunks = [decoder.decode(chunk) for chunk in response.iter_content(65536)]
+    chunks.append(decoder.decode(b'', final=True))
+    return ''.join(chunks)
+
+
+def fetch_url(url, timeout, cache_dir, ttl=0):
+    """
+    Return the body of `url`, using the copy cached in `cache_dir` when it is
+    younger than `ttl` seconds or the server reports it to be unmodified.
+    """
+    import requests
+
+    cache_file = _url_cache_file(cache_dir, url)
+    entry = _read_url_cache(cache_file)
+    headers = {}
+    if entry:
+        if time.time() - entry['fetched_at'] < ttl:
+            return entry['body']
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    with _get_session().get(url, timeout=timeout, headers=headers, stream=True) as response:
+        if entry and response.status_code == 304:
+            entry['fetched_at'] = time.time()
+        elif response.status_code == 200:
+            entry = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'body': _read_body(response),
+                'fetched_at': time.time()
+            }
+        else:
+            # When making a connection to the url a status code will be returned
+            # Normally a OK (200) response would we be returned all other responses
+            # an error will be raised could be separated futher
+            raise requests.exceptions.HTTPError(response.reason, response=response)
+
+    try:
+        _write_url_cache(cache_file, entry)
+    except (IOError, OSError):
+        # failing to cache is not a reason to fail the build
+        pass
+
+    return entry['body']
 
 
 def remove(doc, key):
-    if key in ('*', '**'):
+    if key in _WILDCARDS:
         raise ValueError('Supplied JSON path is invalid')
     del doc[key]
 
 
 def remove_empty(doc, key):
-    if key in ('*', '**'):
+    if key in _WILDCARDS:
         raise ValueError('Supplied JSON path is invalid')
     if not doc[key]:
         del doc[key]
@@ -151,18 +453,22 @@ def tag_noescape(doc, key):
 
 def jsonpath_list(item):
     if item:
-        return list(csv.reader([item])).pop()
+        return [_compile_path(path) for path in list(csv.reader([item])).pop()]
     raise ValueError('Invalid JSON path: "%s"' % item)
 
 
+_FLAG_TRUE = frozenset(('on', 'true'))
+_FLAG_FALSE = frozenset(('off', 'false'))
+
+
 def flag(argument):
     if argument is None:
         return True
 
     value = argument.lower().strip()
-    if value in ['on', 'true']:
+    if value in _FLAG_TRUE:
         return True
-    if value in ['off', 'false']:
+    if value in _FLAG_FALSE:
         return False
     raise ValueError(
         '"%s" unknown, choose from "On", "True", "Off" or "False"' % argument)
@@ -186,24 +492,27 @@ class JsonSchema(Directive):
         try:
             schema, source, pointer = self.get_json_data()
 
-            if self.options.get('hide_key'):
-                for hide_path in self.options['hide_key']:
-                    json_path_transform(schema, hide_path, remove)
-            if self.options.get('hide_key_if_empty'):
-                for hide_path in self.options['hide_key_if_empty']:
-                    json_path_transform(schema, hide_path, remove_empty)
-            if self.options.get('pass_unmodified'):
-                for path in self.options['pass_unmodified']:
-                    json_path_transform(schema, path, tag_noescape)
+            options = self.options
+            if options.get('hide_key'):
+                _json_bind_paths(schema, options['hide_key'], remove)
+            if options.get('hide_key_if_empty'):
+                # one at a time since whether a value is empty depends on the paths before it
+                for hide_path in options['hide_key_if_empty']:
+                    _json_bind(schema, hide_path, remove_empty)
+            if options.get('pass_unmodified'):
+                _json_bind_paths(schema, options['pass_unmodified'], tag_noescape)
 
             format = WideFormat(self.state, self.lineno, source,
-                                self.options, self.state.document.settings.env.app)
+                                options, self.state.document.settings.env.app)
             return format.run(schema, pointer)
         except SystemMessagePropagation as detail:
             return [detail.args[0]]
         except DirectiveError as error:
             raise self.directive_error(error.level, error.msg)
         except Exception as error:
+            if not self.state.document.settings.env.app.config.jsonschema_verbose:
+                raise self.error('%s: %s' % (type(error).__name__, error))
+
             tb = error.__traceback__
             # loop through all traceback points to only return the last traceback
             while tb and tb.tb_next:
@@ -284,21 +593,28 @@ class JsonSchema(Directive):
             raise self.error('"%s" directive requires requests when loading from http.'
                              ' Try "pip install requests".' % self.name)
 
+        env = self.state.document.settings.env
+        app = env.app
+        # remember the url so the next build can prefetch it when this document changes
+        if not hasattr(env, 'jsonschema_urls'):
+            env.jsonschema_urls = {}
+        env.jsonschema_urls.setdefault(env.docname, set()).add((url, timeout))
+
         try:
-            response = requests.get(url, timeout=timeout)
+            data = _prefetched.get((url, timeout))
+            if isinstance(data, Exception):
+                # prefetching already failed, report it instead of trying again
+                raise data
+            if data is None:
+                data = fetch_url(url, timeout, _url_cache_dir(app),
+                                 app.config.jsonschema_url_cache_ttl)
+        except requests.exceptions.HTTPError as e:
+            raise self.error(u'"%s" directive received an "%s" when loading from url: %s.'
+                             % (self.name, e, url))
         except requests.exceptions.RequestException as e:
             raise self.error(u'"%s" directive recieved an "%s" when loading from url: %s.'
                              % (self.name, type(e), url))
 
-        if response.status_code != 200:
-            # When making a connection to the url a status code will be returned
-            # Normally a OK (200) response would we be returned all other responses
-            # an error will be raised could be separated futher
-            raise self.error(u'"%s" directive received an "%s" when loading from url: %s.'
-                             % (self.name, response.reason, url))
-
-        # response content always binary converting with decode() no specific format defined
-        data = response.content.decode()
         return data, url
 
     def _convert_filename(self, filename):
@@ -363,35 +679,79 @@ class JsonSchema(Directive):
             val.append('')
         return val
 
-    def ordered_load(self, text, Loader=yaml.SafeLoader, object_pairs_hook=OrderedDict):
-        """Allows you to use `pyyaml` to load as OrderedDict.
+    def ordered_load(self, text):
+        """Load `text` as YAML (or plain JSON) keeping the order of mappings.
 
-        Taken from https://stackoverflow.com/a/21912744/1927102
+        Parsed schemas are cached, every caller gets its own copy since the
+        result is modified while it is rendered.
         """
-        class OrderedLoader(Loader):
-            pass
+        return copy.deepcopy(_ordered_load(text))
+
+
+def _url_cache_dir(app):
+    return os.path.join(app.doctreedir, 'jsonschema_http_cache')
+
 
-        def construct_mapping(loader, node):
-            loader.flatten_mapping(node)
-            return object_pairs_hook(loader.construct_pairs(node))
+# schemas, or the error loading them, downloaded before reading the
+# documents that refer to them by (url, timeout)
+_prefetched = {}
 
-        OrderedLoader.add_constructor(
-            yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
-            construct_mapping)
 
-        text = text.replace(r'\\(', r'\\\\(')
-        text = text.replace(r'\\)', r'\\\\)')
+def prefetch_urls(app, env, docnames):
+    """
+    Download the schemas the documents about to be read loaded by URL during
+    the previous build in parallel, instead of one at a time while the
+    directives run.
+    """
+    _prefetched.clear()
+    try:
+        import requests
+    except ImportError:
+        return
+
+    loaded = getattr(env, 'jsonschema_urls', {})
+    urls = set()
+    for docname in docnames:
+        urls.update(loaded.get(docname, ()))
+
+    def prefetch(key):
+        url, timeout = key
         try:
-            result = yaml.load(text, OrderedLoader)
-        except yaml.scanner.ScannerError:
-            # will it load as plain json?
-            result = json.loads(text, object_pairs_hook=object_pairs_hook)
-        return result
+            _prefetched[key] = fetch_url(url, timeout, _url_cache_dir(app),
+                                         app.config.jsonschema_url_cache_ttl)
+        except Exception as error:
+            # the directive reports the error when it loads the url
+            _prefetched[key] = error
+
+    if urls:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(prefetch, urls))
+
+
+def purge_urls(app, env, docname):
+    if hasattr(env, 'jsonschema_urls'):
+        env.jsonschema_urls.pop(docname, None)
+
+
+def merge_urls(app, env, docnames, other):
+    """ Collect the urls loaded by documents read in parallel processes """
+    if not hasattr(other, 'jsonschema_urls'):
+        return
+    if not hasattr(env, 'jsonschema_urls'):
+        env.jsonschema_urls = {}
+    for docname in docnames:
+        if docname in other.jsonschema_urls:
+            env.jsonschema_urls[docname] = other.jsonschema_urls[docname]
 
 
 def setup(app):
     app.add_directive('jsonschema', JsonSchema)
+    app.connect('env-before-read-docs', prefetch_urls)
+    app.connect('env-purge-doc', purge_urls)
+    app.connect('env-merge-info', merge_urls)
     app.add_config_value('jsonschema_options', {}, 'env')
+    app.add_config_value('jsonschema_url_cache_ttl', 0, '')
+    app.add_config_value('jsonschema_verbose', False, '')
     return {
         'parallel_read_safe': True,
         'version': '1.19.0'
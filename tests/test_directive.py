@@ -0,0 +1,36 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from unittest.mock import Mock
+
+from docutils.parsers.rst import DirectiveError
+
+jsonschema = __import__('sphinx-jsonschema')
+
+def failing_directive(verbose):
+    state = Mock()
+    state.document.settings.env.app.config.jsonschema_verbose = verbose
+    directive = jsonschema.JsonSchema(
+        'jsonschema', [], {}, [], 1, 0, '.. jsonschema::', state, Mock())
+
+    def get_json_data():
+        raise ValueError('boom')
+
+    directive.get_json_data = get_json_data
+    return directive
+
+def test_error_message():
+    with pytest.raises(DirectiveError) as error:
+        failing_directive(False).run()
+    assert error.value.msg == 'ValueError: boom'
+
+def test_error_message_verbose():
+    with pytest.raises(DirectiveError) as error:
+        failing_directive(True).run()
+    assert error.value.msg.startswith('Traceback (most recent call last):\n')
+    # only the frame that raised the error is included
+    assert error.value.msg.count('  File ') == 1
+    assert 'in get_json_data' in error.value.msg
+    assert error.value.msg.endswith('ValueError: boom\n')
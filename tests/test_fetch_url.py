@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import time
+import types
+
+import pytest
+import requests
+
+jsonschema = __import__('sphinx-jsonschema')
+
+URL = 'http://example.com/schema.json'
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=b'', headers=None, reason='OK', encoding=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+        self.reason = reason
+        self.encoding = encoding
+
+    def iter_content(self, chunk_size):
+        for idx in range(0, len(self.body), chunk_size):
+            yield self.body[idx:idx + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FakeSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+        self.timeouts = {}
+
+    def get(self, url, timeout=None, headers=None, stream=False):
+        self.requests.append(headers)
+        self.timeouts[url] = timeout
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+@pytest.fixture
+def session(monkeypatch):
+    def install(*responses):
+        fake = FakeSession(*responses)
+        monkeypatch.setattr(jsonschema, '_session', fake)
+        return fake
+    return install
+
+def cache_entry(cache_dir):
+    with open(jsonschema._url_cache_file(str(cache_dir), URL), encoding='utf-8') as file:
+        return json.load(file)
+
+def test_fetch_stores_in_cache(session, tmp_path):
+    session(FakeResponse(200, b'{"a": 1}', {'ETag': '"v1"'}))
+    assert jsonschema.fetch_url(URL, 30, str(tmp_path)) == '{"a": 1}'
+    entry = cache_entry(tmp_path)
+    assert entry['body'] == '{"a": 1}'
+    assert entry['etag'] == '"v1"'
+    assert entry['last_modified'] is None
+
+def test_fetch_not_modified(session, tmp_path):
+    session(FakeResponse(200, b'{"a": 1}', {'ETag': '"v1"'}))
+    jsonschema.fetch_url(URL, 30, str(tmp_path))
+    fake = session(FakeResponse(304, reason='Not Modified'))
+    assert jsonschema.fetch_url(URL, 30, str(tmp_path)) == '{"a": 1}'
+    assert fake.requests == [{'If-None-Match': '"v1"'}]
+
+def test_fetch_within_ttl(session, tmp_path):
+    session(FakeResponse(200, b'{"a": 1}'))
+    jsonschema.fetch_url(URL, 30, str(tmp_path))
+    fake = session()
+    assert jsonschema.fetch_url(URL, 30, str(tmp_path), ttl=60) == '{"a": 1}'
+    assert fake.requests == []
+
+def test_fetch_error(session, tmp_path):
+    session(FakeResponse(404, reason='Not Found'))
+    with pytest.raises(requests.exceptions.HTTPError):
+        jsonschema.fetch_url(URL, 30, str(tmp_path))
+    assert not os.path.exists(jsonschema._url_cache_file(str(tmp_path), URL))
+
+@pytest.mark.parametrize('content', ['{"body": "x"}', '[1, 2]', '"text"',
+                                     '{"body": 1, "fetched_at": 0, "etag": null, "last_modified": null}'])
+def test_fetch_ignores_foreign_cache_file(session, tmp_path, content):
+    with open(jsonschema._url_cache_file(str(tmp_path), URL), 'w', encoding='utf-8') as file:
+        file.write(content)
+    fake = session(FakeResponse(200, b'{"a": 1}'))
+    assert jsonschema.fetch_url(URL, 30, str(tmp_path), ttl=time.time()) == '{"a": 1}'
+    assert fake.requests == [{}]
+
+def test_session_shared_between_threads(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    monkeypatch.setattr(jsonschema, '_session', None)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        sessions = list(executor.map(lambda _: jsonschema._get_session(), range(32)))
+    assert all(session is sessions[0] for session in sessions)
+
+def prefetch(tmp_path, urls):
+    app = types.SimpleNamespace(
+        doctreedir=str(tmp_path / 'doctrees'),
+        config=types.SimpleNamespace(jsonschema_url_cache_ttl=0))
+    env = types.SimpleNamespace(jsonschema_urls={'index': urls, 'other': {('http://example.com/other.json', 30)}})
+    jsonschema.prefetch_urls(app, env, ['index'])
+
+def test_prefetch_loaded_urls(session, tmp_path):
+    fake = session(FakeResponse(200, b'{"a": 1}'))
+    prefetch(tmp_path, {(URL, 2)})
+    assert fake.timeouts == {URL: 2}
+    assert jsonschema._prefetched == {(URL, 2): '{"a": 1}'}
+
+@pytest.mark.parametrize('response', [
+    FakeResponse(200, b'{"title": "caf\xe9"}'),
+    requests.exceptions.ConnectionError('refused')
+])
+def test_prefetch_keeps_errors(session, tmp_path, response):
+    session(response)
+    prefetch(tmp_path, {(URL, 30)})
+    assert isinstance(jsonschema._prefetched[(URL, 30)], Exception)
+
+def test_prefetch_only_urls_loaded_by_directives(monkeypatch, tmp_path):
+    sphinx_application = pytest.importorskip('sphinx.application')
+
+    class RecordingSession:
+        def __init__(self):
+            self.urls = []
+
+        def get(self, url, timeout=None, headers=None, stream=False):
+            self.urls.append(url)
+            return FakeResponse(200, b'{"title": "Example", "type": "string"}')
+
+    fake = RecordingSession()
+    monkeypatch.setattr(jsonschema, '_session', fake)
+
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'conf.py').write_text('extensions = ["sphinx-jsonschema"]\n', encoding='utf-8')
+    (src / 'index.rst').write_text(
+        'Index\n'
+        '=====\n\n'
+        '.. code-block:: rst\n\n'
+        '    .. jsonschema:: http://example.com/code-block.json\n\n'
+        '..\n'
+        '    .. jsonschema:: http://example.com/comment.json\n\n'
+        '.. jsonschema:: %s\n' % URL, encoding='utf-8')
+
+    def build():
+        app = sphinx_application.Sphinx(
+            str(src), str(src), str(tmp_path / 'out'), str(tmp_path / 'doctrees'),
+            'html', status=None, warning=None, freshenv=False)
+        app.build()
+        return app
+
+    app = build()
+    assert fake.urls == [URL]
+    assert app.env.jsonschema_urls == {'index': {(URL, 30)}}
+
+    fake.urls.clear()
+    index = src / 'index.rst'
+    index.write_text(index.read_text(encoding='utf-8') + '\n', encoding='utf-8')
+    os.utime(str(index), (time.time() + 10, time.time() + 10))
+    build()
+    assert fake.urls == [URL]
+    assert jsonschema._prefetched == {(URL, 30): '{"title": "Example", "type": "string"}'}
+
+@pytest.mark.parametrize('content_type, encoding, body, expected', [
+    ('application/json; charset=iso-8859-1', 'iso-8859-1', 'café'.encode('latin-1'), 'café'),
+    ('text/plain', 'ISO-8859-1', 'café'.encode(), 'café'),
+    ('application/json; charset=unknown', 'unknown', 'café'.encode(), 'café'),
+    ('application/json; nocharset', None, 'café'.encode(), 'café'),
+    ('application/json', 'utf-8', b'a' * 65535 + 'é'.encode(), 'a' * 65535 + 'é')
+])
+def test_read_body(content_type, encoding, body, expected):
+    response = FakeResponse(200, body, {'Content-Type': content_type}, encoding=encoding)
+    assert jsonschema._read_body(response) == expected
+
+def test_write_cache_from_threads(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    cache_file = jsonschema._url_cache_file(str(tmp_path), URL)
+    entries = [{'etag': None, 'last_modified': None, 'body': str(n) * 10000, 'fetched_at': n}
+               for n in range(16)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda entry: jsonschema._write_url_cache(cache_file, entry), entries))
+    assert jsonschema._read_url_cache(cache_file) in entries
+    assert os.listdir(str(tmp_path)) == [os.path.basename(cache_file)]
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires os.fork')
+def test_session_not_shared_with_forked_child():
+    parent = jsonschema._get_session()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        shared = jsonschema._session is not None or jsonschema._get_session() is parent
+        os.write(write_fd, b'1' if shared else b'0')
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.read(read_fd, 1) == b'0'
+    assert jsonschema._get_session() is parent
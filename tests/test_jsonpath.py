@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import pytest
+import yaml
+
+jsonschema = __import__('sphinx-jsonschema')
+
+def test_validate_plain():
+    assert jsonschema.json_path_validate(['properties', 'name'])
+
+def test_validate_single_wildcards():
+    assert jsonschema.json_path_validate(['**', 'examples'])
+    assert jsonschema.json_path_validate(['properties', '*', 'default'])
+
+def test_validate_consecutive_wildcards():
+    assert not jsonschema.json_path_validate(['*', '*', 'examples'])
+    assert not jsonschema.json_path_validate(['properties', '**', '*'])
+
+def test_transform_invalid_path():
+    with pytest.raises(ValueError):
+        jsonschema.json_path_transform({}, '/**/**/examples', jsonschema.remove)
+
+def test_jsonpath_list_compiles():
+    paths = jsonschema.jsonpath_list('/**/examples,"/items/0/with, comma"')
+    assert paths == [
+        ((), (jsonschema.OP_DEEP_WILD, (('examples',), None), None)),
+        (('items', 0, 'with, comma'), None)
+    ]
+
+def test_jsonpath_list_invalid():
+    with pytest.raises(ValueError):
+        jsonschema.jsonpath_list('/*/**/examples')
+
+def test_ordered_load_keeps_order():
+    result = jsonschema._ordered_load('{"b": 1, "a": {"d": 2, "c": 3}}')
+    assert list(result) == ['b', 'a']
+    assert list(result['a']) == ['d', 'c']
+
+def test_ordered_load_yaml():
+    result = jsonschema._ordered_load('title: Example\ntype: object\n')
+    assert list(result) == ['title', 'type']
+
+def test_transform_deep_wildcard():
+    schema = {
+        'examples': [1],
+        'properties': {
+            'name': {'type': 'string', 'examples': ['a']},
+            'tags': {'type': 'array', 'items': [{'examples': ['b']}]}
+        }
+    }
+    jsonschema.json_path_transform(schema, '/**/examples', jsonschema.remove)
+    assert schema == {
+        'properties': {
+            'name': {'type': 'string'},
+            'tags': {'type': 'array', 'items': [{}]}
+        }
+    }
+
+def test_transform_index():
+    schema = {'examples': ['a', 'b']}
+    jsonschema.json_path_transform(schema, '/examples/0', jsonschema.remove)
+    assert schema == {'examples': ['b']}
+
+def test_validate_empty():
+    assert not jsonschema.json_path_validate([])
+
+def test_compile_single_wildcard():
+    program = jsonschema.jsonpath_list('/properties/*/a/b').pop()
+    assert program == (
+        ('properties',),
+        (jsonschema.OP_WILD, (('a', 'b'), None), (('b',), None))
+    )
+
+def test_transform_wildcard_followed_by_deep_wildcard():
+    schema = {'a': {'b': {'c': 1}, 'x': {'c': 2}}, 'd': {'b': {'e': {'c': 3}}}}
+    jsonschema.json_path_transform(schema, '/*/b/**/c', jsonschema.remove)
+    assert schema == {'a': {'b': {}, 'x': {}}, 'd': {'b': {'e': {}}}}
+
+def test_transform_missing_parts():
+    schema = {'items': ['a'], 'title': 'Example'}
+    jsonschema.json_path_transform(schema, '/items/1', jsonschema.remove)
+    jsonschema.json_path_transform(schema, '/items/name', jsonschema.remove)
+    jsonschema.json_path_transform(schema, '/title/0', jsonschema.remove)
+    jsonschema.json_path_transform(schema, '/missing/key', jsonschema.remove)
+    assert schema == {'items': ['a'], 'title': 'Example'}
+
+def test_transform_trailing_wildcard_list():
+    schema = {'examples': ['a', 'b', 'c']}
+    jsonschema.json_path_transform(schema, '/examples/*', jsonschema.remove)
+    assert schema == {'examples': []}
+
+def test_bind_trie():
+    schema = {
+        'examples': [1],
+        'properties': {
+            'name': {'type': 'string', 'default': 'a', 'examples': ['a']},
+            'size': {'type': 'integer', 'default': 1}
+        }
+    }
+    paths = jsonschema.jsonpath_list('/**/examples,/**/default,/properties/size/type')
+    jsonschema._json_bind_trie(schema, jsonschema._path_trie(paths), jsonschema.remove)
+    assert schema == {
+        'properties': {
+            'name': {'type': 'string'},
+            'size': {}
+        }
+    }
+
+def test_ordered_load_escaped_parens():
+    result = jsonschema._ordered_load(r'{"description": "\\(x\\) (y)"}')
+    assert result['description'] == r'\\(x\\) (y)'
+
+def test_flag():
+    assert jsonschema.flag(None)
+    assert jsonschema.flag(' On ')
+    assert not jsonschema.flag('False')
+    with pytest.raises(ValueError):
+        jsonschema.flag('maybe')
+
+def test_bind_paths_keeps_index_order():
+    schema = {'items': [{'title': 'i0'}, {'title': 'i1'}, {'title': 'i2'}]}
+    paths = jsonschema.jsonpath_list('/items/1/title,/items/0')
+    jsonschema._json_bind_paths(schema, paths, jsonschema.remove)
+    assert schema == {'items': [{}, {'title': 'i2'}]}
+
+def test_bind_paths_wildcard_index_order():
+    schema = ['x', 'y', 'z']
+    paths = jsonschema.jsonpath_list('/*/1,/*/0')
+    jsonschema._json_bind_paths(schema, paths, jsonschema.remove)
+    assert schema == ['z']
+
+def test_ordered_load_numbers_as_yaml():
+    text = '{"a": 1e5, "b": 1e-9, "c": 1.5e3, "d": 1.5e+3, "e": 2.5, "f": 3, "g": NaN}'
+    result = jsonschema._ordered_load(text)
+    assert result == {'a': '1e5', 'b': '1e-9', 'c': '1.5e3', 'd': 1500.0,
+                      'e': 2.5, 'f': 3, 'g': 'NaN'}
+    assert result == yaml.safe_load(text)